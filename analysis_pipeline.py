@@ -4,9 +4,16 @@ import open3d as o3d
 from scipy import ndimage
 from skimage import measure
 from pathlib import Path
-import traceback
-import time
-from typing import TypedDict, Dict, Any, Callable, Optional
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import atexit
+import multiprocessing
+import itertools
+import os
+import logging
+import queue
+import threading
+from typing import TypedDict, Dict, Any, Callable, Optional, Tuple
 
 # Import from existing utils
 from utils.metrics_utils import (
@@ -15,8 +22,26 @@ from utils.metrics_utils import (
     compute_mesh_metrics,
     compute_reconstruction_quality_metrics,
 )
+from utils.geometric_utils import apply_affine
 from utils.plot_utils import create_flat_disc
 
+logger = logging.getLogger(__name__)
+
+# Worker processes shared by every analysis, started on first use by _vessel_pool()
+_VESSEL_POOL: Optional[ProcessPoolExecutor] = None
+_VESSEL_POOL_LOCK = threading.Lock()
+# Workers tag their progress messages with the job id of the analysis they belong to;
+# whichever analysis drains the shared queue hands each message to its owner's route
+_STATUS_QUEUE = None
+_STATUS_QUEUE_LOCK = threading.Lock()
+_STATUS_ROUTES: Dict[int, "queue.SimpleQueue[str]"] = {}
+_JOB_IDS = itertools.count()
+# Crops smaller than this in total are reconstructed in-process: handing them to the
+# workers costs more in pickling and scheduling than the parallelism saves
+PARALLEL_MIN_VOXELS = 2_000_000
+# Set in each worker process by _init_vessel_worker
+_WORKER_STATUS_QUEUE = None
+
 # --- NEW: Define serializable types for geometries ---
 class SerializableMesh(TypedDict):
     vertices: np.ndarray
@@ -47,6 +72,229 @@ class AnalysisResult(TypedDict):
     vessels: Dict[str, VesselData]
 
 
+# Geometry is stored as contiguous float32 coordinates and int32 indices, which
+# halves the data cached by Streamlit and serialized for Plotly
+def _serializable_mesh(vertices, triangles) -> SerializableMesh:
+    return {
+        "vertices": np.ascontiguousarray(vertices, dtype=np.float32),
+        "triangles": np.ascontiguousarray(triangles, dtype=np.int32),
+    }
+
+def _serializable_lineset(points, lines) -> SerializableLineSet:
+    return {
+        "points": np.ascontiguousarray(points, dtype=np.float32),
+        "lines": np.ascontiguousarray(lines, dtype=np.int32),
+    }
+
+def _serializable_point_cloud(points, colors) -> SerializablePointCloud:
+    return {
+        "points": np.ascontiguousarray(points, dtype=np.float32),
+        "colors": np.ascontiguousarray(colors, dtype=np.float32),
+    }
+
+
+def _load_npz_array(path: str, key: str) -> np.ndarray:
+    """Reads a single array from an .npz archive and closes the archive."""
+    with np.load(path) as data:
+        return data[key]
+
+
+def _init_vessel_worker(status_queue) -> None:
+    """Worker process initializer: keeps the shared status queue for _run_vessel_job."""
+    global _WORKER_STATUS_QUEUE
+    _WORKER_STATUS_QUEUE = status_queue
+
+
+def _run_vessel_job(job_id: int, *args) -> Optional[VesselData]:
+    """Worker entry point: runs _process_vessel, tagging its status messages with `job_id`."""
+    return _process_vessel(*args, lambda message: _WORKER_STATUS_QUEUE.put((job_id, message)))
+
+
+def _vessel_pool() -> ProcessPoolExecutor:
+    """
+    Returns the process pool shared by all analyses, creating it on first use.
+
+    Streamlit serves the app from a multithreaded process, where fork() can deadlock
+    on locks held by other threads, so workers come from a forkserver that has this
+    module preloaded (the forkserver finds it through the working directory, which
+    is the app directory under Streamlit). They also skip re-importing __main__,
+    which under Streamlit is the app script itself.
+    """
+    global _VESSEL_POOL, _STATUS_QUEUE
+    from utils.process_utils import NoMainForkServerContext
+
+    with _VESSEL_POOL_LOCK:
+        if _VESSEL_POOL is None:
+            mp_context = NoMainForkServerContext()
+            mp_context.set_forkserver_preload([__name__])
+            # SimpleQueue.put writes straight to the pipe, so a worker's messages are
+            # readable before its result is
+            _STATUS_QUEUE = mp_context.SimpleQueue()
+            _VESSEL_POOL = ProcessPoolExecutor(
+                max_workers=os.cpu_count() or 1,
+                mp_context=mp_context,
+                initializer=_init_vessel_worker,
+                initargs=(_STATUS_QUEUE,),
+            )
+            # Shut the workers down while the interpreter is still intact
+            atexit.register(_VESSEL_POOL.shutdown)
+        return _VESSEL_POOL
+
+
+def _discard_vessel_pool() -> None:
+    """Drops a broken pool, so the next analysis starts a fresh one."""
+    global _VESSEL_POOL
+    with _VESSEL_POOL_LOCK:
+        if _VESSEL_POOL is not None:
+            _VESSEL_POOL.shutdown(wait=False, cancel_futures=True)
+            _VESSEL_POOL = None
+
+
+def _drain_status_queue(job_id: int, status_callback: Callable[[str], None]) -> None:
+    """Routes waiting worker messages to their analyses and forwards those of `job_id`."""
+    with _STATUS_QUEUE_LOCK:
+        while not _STATUS_QUEUE.empty():
+            owner, message = _STATUS_QUEUE.get()
+            route = _STATUS_ROUTES.get(owner)
+            if route is not None:
+                route.put(message)
+    route = _STATUS_ROUTES[job_id]
+    while True:
+        try:
+            status_callback(route.get_nowait())
+        except queue.Empty:
+            return
+
+
+def _process_vessel(
+    name: str,
+    mask: np.ndarray,
+    bbox_origin: np.ndarray,
+    volume_shape: Tuple[int, int, int],
+    affine: np.ndarray,
+    points: Optional[np.ndarray],
+    destination_folder: Path,
+    patient_id: str,
+    status_callback: Callable[[str], None],
+) -> Optional[VesselData]:
+    """
+    Reconstructs and analyzes a single vessel. May run in a worker process, so apart
+    from `status_callback` it only takes picklable inputs.
+
+    Args:
+        name: vessel name
+        mask: binary vessel mask, cropped to the vessel's bounding box
+        bbox_origin: voxel index of the cropped mask's first voxel in the full volume
+        volume_shape: shape of the full segmentation volume
+        affine: affine matrix of the full volume
+        points: point cloud points labelled as this vessel, or None
+        destination_folder: folder where the diameter plot is saved
+        patient_id: patient identifier used in the plot path
+        status_callback: receives progress messages
+    """
+    voxel_spacing = np.linalg.norm(affine[:3, :3], axis=0)
+    # Maps voxel indices of the cropped mask to patient space
+    mask_affine = affine.copy()
+    mask_affine[:3, 3] = apply_affine(bbox_origin[np.newaxis], affine)[0]
+
+    vessel_results: VesselData = {
+        "mesh": None, "centerline": None, "max_diameter_disc": None,
+        "metrics": {}, "diameter_plot_path": None, "diameter_plot_bytes": None
+    }
+
+    status_callback(f"Reconstructing mesh for {name}...")
+    pad_amount = 2
+    sigma = 1
+    # Only the label's bounding box is filtered and meshed. Where the crop reaches
+    # the volume edge it gets the full volume's padding, so the reflect-mode filter
+    # mirrors the same border; elsewhere the zero padding covers the filter radius,
+    # so the reflection only sees the background that surrounds the crop
+    filter_radius = int(4.0 * sigma + 0.5)
+    bbox_end = bbox_origin + np.array(mask.shape)
+    pad_width = [
+        (pad_amount if start == 0 else filter_radius, pad_amount if end == dim else filter_radius)
+        for start, end, dim in zip(bbox_origin, bbox_end, volume_shape)
+    ]
+    pad_before = np.array([before for before, _ in pad_width])
+    padded_mask = np.pad(mask, pad_width=pad_width, mode="constant", constant_values=0)
+    ndimage.binary_fill_holes(padded_mask, output=padded_mask)
+    # Smooth in place, so the float volume is allocated only once
+    smoothed = padded_mask.astype(np.float32)
+    ndimage.gaussian_filter(smoothed, sigma=sigma, output=smoothed)
+    # get vertices in voxel coord
+    try:
+        verts, faces, _, _ = measure.marching_cubes(smoothed, level=0.2, spacing=voxel_spacing)
+    except (ValueError, RuntimeError) as e:
+        status_callback(f"ERROR reconstructing mesh for {name}: {e}")
+        logger.warning("Marching cubes failed for %s: %s", name, e)
+        return None
+    # account for padding and the bounding box offset
+    verts += (bbox_origin - pad_before) * voxel_spacing
+    
+    # --- FIX: Apply full affine transformation to get to patient space ---
+    verts_world = apply_affine(verts, affine)
+
+    mesh = o3d.geometry.TriangleMesh(
+        o3d.utility.Vector3dVector(verts), o3d.utility.Vector3iVector(faces)
+    )
+    mesh.compute_vertex_normals()
+    # --- MODIFIED: Store serializable data instead of o3d object ---
+    vessel_results["mesh"] = _serializable_mesh(mesh.vertices, mesh.triangles)
+
+    # The mesh metrics don't depend on the centerline, and Open3D's watertight
+    # check releases the GIL, so it runs in a thread alongside the analysis
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        mesh_metrics = executor.submit(compute_mesh_metrics, mesh)
+
+        status_callback(f"Analyzing centerline for {name}...")
+        try:
+            centerline_analysis = compute_centerline_metrics(
+                mask, mask_affine, name=name, destination_folder=destination_folder, patient_id=patient_id, debug_mode=False
+            )
+        except OSError as e:
+            status_callback(f"WARNING: Could not save the diameter profile for {name}: {e}")
+            logger.warning("Centerline analysis failed for %s: %s", name, e)
+            centerline_analysis = None
+
+        try:
+            mesh_surface, mesh_volume, is_watertight = mesh_metrics.result()
+            vessel_results["metrics"]["surface_area"] = mesh_surface
+            vessel_results["metrics"]["volume"] = mesh_volume
+            vessel_results["metrics"]["is_watertight"] = is_watertight
+        except RuntimeError as e:
+            status_callback(f"WARNING: Could not compute mesh metrics for {name}: {e}")
+            logger.warning("Mesh metrics failed for %s: %s", name, e)
+
+    if centerline_analysis and centerline_analysis["metrics"]:
+        vessel_results["metrics"]["centerline"] = centerline_analysis["metrics"]
+        vessel_results["diameter_plot_path"] = str(centerline_analysis["plot_path"])
+
+        vis_data = centerline_analysis.get("vis_data", {})
+        if vis_data and vis_data.get("points") is not None and vis_data.get("connections") is not None:
+            # --- MODIFIED: Store serializable data ---
+            vessel_results["centerline"] = _serializable_lineset(vis_data["points"], vis_data["connections"])
+
+        max_diam_loc_mm = centerline_analysis["metrics"].get("max_diameter_location")
+        if max_diam_loc_mm is not None:
+            disc = create_flat_disc(
+                center=max_diam_loc_mm,
+                radius=float(centerline_analysis["metrics"]["diameters"]["max"] / 2),
+                normal=centerline_analysis["metrics"].get('tangent_at_max_diameter_location')
+            )
+            # --- MODIFIED: Store serializable data ---
+            vessel_results["max_diameter_disc"] = _serializable_mesh(disc.vertices, disc.triangles)
+
+    if points is not None and len(points) > 0:
+        status_callback(f"Calculating reconstruction quality for {name}...")
+        try:
+            vessel_results["metrics"]["quality"] = compute_reconstruction_quality_metrics(points, mesh)
+        except RuntimeError as e:
+            status_callback(f"WARNING: Could not compute reconstruction quality for {name}: {e}")
+            logger.warning("Reconstruction quality failed for %s: %s", name, e)
+
+    return vessel_results
+
+
 def enhanced_vessel_reconstruction_analysis(
     scan_nifti_file: str,
     segmentation_file: str,
@@ -61,26 +309,28 @@ def enhanced_vessel_reconstruction_analysis(
     results: AnalysisResult = {"vessels": {}}
     
     status_callback("Loading data...")
-    time.sleep(0.5)
+
+    # The inputs are independent files, so they are read concurrently
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        seg_future = executor.submit(_load_npz_array, segmentation_file, "new_seg_scan")
+        pcd_future = executor.submit(_load_npz_array, pointcloud_file, "points")
+        scan_future = executor.submit(nib.load, scan_nifti_file)
 
     try:
-        seg_data = np.load(segmentation_file)
-        new_seg_scan = seg_data["new_seg_scan"]
+        new_seg_scan = seg_future.result()
     except Exception as e:
         status_callback(f"ERROR: Could not load segmentation file: {e}")
         return results
 
     try:
-        pcd_data = np.load(pointcloud_file)
-        points = pcd_data["points"]
+        points = pcd_future.result()
     except Exception as e:
         status_callback(f"WARNING: Could not load point cloud file: {e}. Quality metrics will be skipped.")
         points = None
     
     try:
-        scan_data = nib.load(scan_nifti_file)
+        scan_data = scan_future.result()
         affine = scan_data.affine
-        voxel_spacing = np.linalg.norm(affine[:3, :3], axis=0)
         inv_affine = np.linalg.inv(affine)
     except Exception as e:
         status_callback(f"ERROR: Could not load NIfTI scan file: {e}")
@@ -88,15 +338,10 @@ def enhanced_vessel_reconstruction_analysis(
 
     if points is not None:
         status_callback("Mapping point cloud to segmentation labels...")
-        time.sleep(0.5)
-        points_homogeneous = np.c_[points, np.ones(points.shape[0])]
-        voxel_coords = (points_homogeneous @ inv_affine.T)[:, :3]
-        voxel_coords = np.round(voxel_coords).astype(int)
-        dims = np.array(new_seg_scan.shape)
-        voxel_coords = np.clip(voxel_coords, [0, 0, 0], dims - 1)
-        point_labels = new_seg_scan[
-            voxel_coords[:, 0], voxel_coords[:, 1], voxel_coords[:, 2]
-        ]
+        voxel_coords = np.rint(apply_affine(points, inv_affine)).astype(np.int64)
+        # Clip each axis to the volume and gather labels through one flat index
+        flat_idx = np.ravel_multi_index(voxel_coords.T, new_seg_scan.shape, mode="clip")
+        point_labels = new_seg_scan.ravel()[flat_idx]
         status_callback("...mapping complete.")
     else:
         point_labels = None
@@ -104,93 +349,76 @@ def enhanced_vessel_reconstruction_analysis(
     colors_rgb = [[1, 0, 0], [0, 1, 0], [0, 0, 1]]
     names = ["Aorta", "Left Iliac Artery", "Right Iliac Artery"]
 
-    for label_idx, (color, name) in enumerate(zip(colors_rgb, names), start=1):
+    # A single pass over the volume yields the bounding box of every label, so
+    # each vessel mask below only compares the voxels inside its own box.
+    if not np.issubdtype(new_seg_scan.dtype, np.integer):
+        new_seg_scan = new_seg_scan.astype(np.int32)
+    label_slices = ndimage.find_objects(new_seg_scan, max_label=len(names))
+
+    vessel_jobs = []
+    for label_idx, name in enumerate(names, start=1):
         status_callback(f"Processing: {name} (Label {label_idx})...")
-        time.sleep(0.5)
 
-        mask = new_seg_scan == label_idx
-        if not np.any(mask):
+        label_slice = label_slices[label_idx - 1]
+        if label_slice is None:
             continue
+        # Crop to the bounding box plus a one-voxel background margin, so the
+        # distance transform sees the same vessel border as on the full volume
+        label_slice = tuple(
+            slice(max(s.start - 1, 0), min(s.stop + 1, dim))
+            for s, dim in zip(label_slice, new_seg_scan.shape)
+        )
+        bbox_origin = np.array([s.start for s in label_slice])
+        mask = new_seg_scan[label_slice] == label_idx
+        vessel_points = points[point_labels == label_idx] if point_labels is not None else None
+        vessel_jobs.append((name, mask, bbox_origin, vessel_points))
 
-        vessel_results: VesselData = {
-            "mesh": None, "centerline": None, "max_diameter_disc": None,
-            "metrics": {}, "diameter_plot_path": None, "diameter_plot_bytes": None
-        }
-
+    # Vessels are independent, so large ones are reconstructed in parallel in the
+    # shared worker pool; workers report progress through the status queue drained here
+    job_args = [
+        (name, mask, bbox_origin, new_seg_scan.shape, affine, vessel_points, destination_folder, patient_id)
+        for name, mask, bbox_origin, vessel_points in vessel_jobs
+    ]
+    run_parallel = (
+        len(job_args) > 1
+        and (os.cpu_count() or 1) > 1
+        and "forkserver" in multiprocessing.get_all_start_methods()
+        and sum(mask.size for _, mask, _, _ in vessel_jobs) >= PARALLEL_MIN_VOXELS
+    )
+    if run_parallel:
+        executor = _vessel_pool()
+        job_id = next(_JOB_IDS)
+        _STATUS_ROUTES[job_id] = queue.SimpleQueue()
         try:
-            status_callback(f"Reconstructing mesh for {name}...")
-            pad_amount = 2
-            padded_mask = np.pad(mask, pad_width=pad_amount, mode="constant", constant_values=0)
-            padded_mask = ndimage.binary_fill_holes(padded_mask)
-            smoothed = ndimage.gaussian_filter(padded_mask.astype(float), sigma=1)
-            # get vertices in voxel coord
-            verts, faces, _, _ = measure.marching_cubes(smoothed, level=0.2, spacing=voxel_spacing)
-            # account for padding
-            verts -= pad_amount * voxel_spacing
-            
-            # --- FIX: Apply full affine transformation to get to patient space ---
-            verts_hom = np.hstack([verts, np.ones((verts.shape[0], 1))])
-            verts_world = (affine @ verts_hom.T).T[:, :3]
-
-            mesh = o3d.geometry.TriangleMesh(
-                o3d.utility.Vector3dVector(verts), o3d.utility.Vector3iVector(faces)
-            )
-            mesh.compute_vertex_normals()
-            # --- MODIFIED: Store serializable data instead of o3d object ---
-            vessel_results["mesh"] = {"vertices": np.asarray(mesh.vertices), "triangles": np.asarray(mesh.triangles)}
-
-            mesh_surface, mesh_volume, is_watertight = compute_mesh_metrics(mesh)
-            vessel_results["metrics"]["surface_area"] = mesh_surface
-            vessel_results["metrics"]["volume"] = mesh_volume
-            vessel_results["metrics"]["is_watertight"] = is_watertight
-
-            status_callback(f"Analyzing centerline for {name}...")
-            centerline_analysis = compute_centerline_metrics(
-                mask, affine, name=name, destination_folder=destination_folder, patient_id=patient_id, debug_mode=False
-            )
-
-            if centerline_analysis and centerline_analysis["metrics"]:
-                vessel_results["metrics"]["centerline"] = centerline_analysis["metrics"]
-                vessel_results["diameter_plot_path"] = str(centerline_analysis["plot_path"])
-
-                vis_data = centerline_analysis.get("vis_data", {})
-                if vis_data and vis_data.get("points") is not None and vis_data.get("connections") is not None:
-                    # --- MODIFIED: Store serializable data ---
-                    vessel_results["centerline"] = {"points": vis_data["points"], "lines": vis_data["connections"]}
-
-                max_diam_loc_mm = centerline_analysis["metrics"].get("max_diameter_location")
-                if max_diam_loc_mm is not None:
-                    disc = create_flat_disc(
-                        center=max_diam_loc_mm,
-                        radius=float(centerline_analysis["metrics"]["diameters"]["max"] / 2),
-                        normal=centerline_analysis["metrics"].get('tangent_at_max_diameter_location')
-                    )
-                    # --- MODIFIED: Store serializable data ---
-                    vessel_results["max_diameter_disc"] = {"vertices": np.asarray(disc.vertices), "triangles": np.asarray(disc.triangles)}
-
-            if points is not None and point_labels is not None:
-                pc_label_mask = point_labels == label_idx
-                if np.any(pc_label_mask):
-                    status_callback(f"Calculating reconstruction quality for {name}...")
-                    quality_metrics = compute_reconstruction_quality_metrics(points[pc_label_mask], mesh)
-                    vessel_results["metrics"]["quality"] = quality_metrics
+            futures = [executor.submit(_run_vessel_job, job_id, *args) for args in job_args]
+            pending = set(futures)
+            while pending:
+                _, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                _drain_status_queue(job_id, status_callback)
+            _drain_status_queue(job_id, status_callback)
+            vessel_outputs = [future.result() for future in futures]
+        except BrokenProcessPool:
+            _discard_vessel_pool()
+            raise
+        finally:
+            del _STATUS_ROUTES[job_id]
+    else:
+        vessel_outputs = [_process_vessel(*args, status_callback) for args in job_args]
 
+    # Insert in label order, regardless of which vessel finished first
+    for (name, *_), vessel_results in zip(job_args, vessel_outputs):
+        if vessel_results is not None:
             results["vessels"][name] = vessel_results
 
-        except Exception as e:
-            status_callback(f"ERROR processing {name}: {e}")
-            traceback.print_exc()
-
     if points is not None and point_labels is not None:
-        pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
-        pcd_colors = np.zeros_like(points, dtype=float)
-        for i, color in enumerate(colors_rgb, 1):
-            pcd_colors[point_labels == i] = color
-        
+        # Row 0 colors the background and any label without a vessel color
+        palette = np.array([[0, 0, 0], *colors_rgb], dtype=float)
+        in_palette = (point_labels > 0) & (point_labels < len(palette))
+        pcd_colors = palette[np.where(in_palette, point_labels, 0)]
+
         # --- MODIFIED: Store serializable data ---
-        results["point_cloud"] = {"geometry": {"points": np.asarray(pcd.points), "colors": pcd_colors}}
+        results["point_cloud"] = {"geometry": _serializable_point_cloud(points, pcd_colors)}
 
     status_callback("Analysis complete!")
-    time.sleep(1)
     
     return results
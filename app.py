@@ -1,11 +1,18 @@
 import streamlit as st
 import plotly.graph_objects as go
 from pathlib import Path
-import time
 import tempfile
 import os
+import hashlib
+import io
+import json
+import time
 from typing import Dict
 
+import numpy as np
+
+import lz4.frame
+
 # Import your custom modules
 # Make sure these files (analysis_pipeline.py, visualization_utils.py) exist and are correct
 from analysis_pipeline import enhanced_vessel_reconstruction_analysis, AnalysisResult
@@ -25,6 +32,18 @@ st.set_page_config(
 
 # --- CONSTANTS ---
 BASE_DATA_DIR = Path("./outputs")
+# Analysis results persisted across app restarts, next to the input data
+ANALYSIS_CACHE_DIR = BASE_DATA_DIR / "analysis_cache"
+# Bump when the analysis output changes so stale persisted results are ignored
+ANALYSIS_CACHE_VERSION = 3
+# The persisted cache is pruned to this total size, oldest entries first
+ANALYSIS_CACHE_MAX_BYTES = 2 * 1024**3
+# Persisted results unused for this long are deleted
+ANALYSIS_CACHE_MAX_AGE_S = 30 * 24 * 3600
+# Temporary files older than this are left over from a crashed writer
+ANALYSIS_CACHE_TMP_MAX_AGE_S = 3600
+# Larger point clouds are randomly subsampled before plotting to keep the 3D view responsive
+MAX_PLOT_POINTS = 200_000
 
 # --- HELPER FUNCTIONS ---
 @st.cache_data
@@ -92,6 +111,116 @@ def find_patient_scans(base_dir: Path) -> Dict[str, Dict[str, Dict[str, str]]]:
             
     return patient_scan_data
 
+def analysis_cache_path(*key_parts) -> Path:
+    """Returns the on-disk cache file for an analysis identified by `key_parts`."""
+    key_str = "|".join(map(str, (ANALYSIS_CACHE_VERSION, *key_parts)))
+    key = hashlib.blake2b(key_str.encode(), digest_size=16).hexdigest()
+    return ANALYSIS_CACHE_DIR / f"{key}.npz.lz4"
+
+def _encode_cache_value(value, arrays: Dict[str, np.ndarray]):
+    """
+    Converts analysis results into a JSON-serializable structure.
+    Arrays and bytes are moved into `arrays` and referenced by key, so the
+    cache file never needs pickle to be read back.
+    """
+    if isinstance(value, dict):
+        return {"dict": {str(k): _encode_cache_value(v, arrays) for k, v in value.items()}}
+    if isinstance(value, np.ndarray):
+        if value.dtype.hasobject:
+            raise TypeError("Object arrays cannot be cached without pickle")
+        key = f"a{len(arrays)}"
+        arrays[key] = value
+        return {"array": key}
+    if isinstance(value, bytes):
+        key = f"a{len(arrays)}"
+        arrays[key] = np.frombuffer(value, dtype=np.uint8)
+        return {"bytes": key}
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return {"value": value}
+    raise TypeError(f"Cannot cache a value of type {type(value).__name__}")
+
+def _decode_cache_value(node, arrays):
+    """Inverse of _encode_cache_value."""
+    if "dict" in node:
+        return {k: _decode_cache_value(v, arrays) for k, v in node["dict"].items()}
+    if "array" in node:
+        return arrays[node["array"]]
+    if "bytes" in node:
+        return arrays[node["bytes"]].tobytes()
+    return node["value"]
+
+def load_cached_analysis(cache_path: Path):
+    """Loads persisted analysis results, or returns None if missing or unreadable."""
+    try:
+        payload = io.BytesIO(lz4.frame.decompress(cache_path.read_bytes()))
+        # allow_pickle=False: the cache directory may be shared, so its files are untrusted
+        with np.load(payload, allow_pickle=False) as npz:
+            arrays = {key: npz[key] for key in npz.files}
+        structure = json.loads(arrays.pop("__structure__").tobytes())
+        results = _decode_cache_value(structure, arrays)
+    except Exception:
+        # A torn, stale or foreign cache file is just a cache miss; the analysis is rerun
+        return None
+    # Mark the entry as recently used, so pruning evicts it last
+    try:
+        os.utime(cache_path)
+    except OSError:
+        pass
+    return results
+
+def prune_analysis_cache(cache_dir: Path = ANALYSIS_CACHE_DIR):
+    """
+    Deletes expired cache entries and leftover temporary files, then the least
+    recently used entries until the cache fits in ANALYSIS_CACHE_MAX_BYTES.
+    """
+    now = time.time()
+    entries = []
+    for path in cache_dir.iterdir():
+        try:
+            stat = path.stat()
+        except OSError:
+            continue  # deleted by another session meanwhile
+        max_age = ANALYSIS_CACHE_TMP_MAX_AGE_S if path.suffix == ".tmp" else ANALYSIS_CACHE_MAX_AGE_S
+        if now - stat.st_mtime > max_age or path.name.endswith(".pkl.lz4"):
+            # .pkl.lz4 files come from an older cache format and are never read
+            path.unlink(missing_ok=True)
+        elif path.name.endswith(".npz.lz4"):
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+        if total_size <= ANALYSIS_CACHE_MAX_BYTES:
+            break
+        path.unlink(missing_ok=True)
+        total_size -= size
+
+def store_cached_analysis(cache_path: Path, results: AnalysisResult):
+    """Persists analysis results, writing to a temporary file first so readers never see partial data."""
+    tmp_path = None
+    try:
+        arrays = {}
+        structure = _encode_cache_value(results, arrays)
+        arrays["__structure__"] = np.frombuffer(json.dumps(structure).encode(), dtype=np.uint8)
+        payload = io.BytesIO()
+        np.savez(payload, **arrays)
+
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # A unique temporary file per writer, so concurrent sessions or pods
+        # sharing the cache directory never interleave writes
+        fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(lz4.frame.compress(payload.getbuffer(), content_checksum=True))
+        os.replace(tmp_path, cache_path)
+        tmp_path = None
+        prune_analysis_cache(cache_path.parent)
+    except (OSError, TypeError, ValueError) as e:
+        st.warning(f"Could not persist analysis results: {e}")
+    finally:
+        if tmp_path is not None:
+            Path(tmp_path).unlink(missing_ok=True)
+
 # --- CACHED ANALYSIS FUNCTION ---
 @st.cache_data(show_spinner=False, max_entries=3)
 def run_analysis(
@@ -101,8 +230,17 @@ def run_analysis(
     """
     Wrapper around the main analysis function, cached based on file paths
     and their modification times to detect content changes.
-    Cache will store up to 10 results and discard the least recently used.
+    Cache will store up to 3 results in memory and discard the least recently used.
+    Results are also persisted to ANALYSIS_CACHE_DIR, so they survive app restarts.
     """
+    cache_path = analysis_cache_path(
+        nifti_path, seg_path, pcd_path, patient_id, nifti_mtime, seg_mtime, pcd_mtime
+    )
+    if cache_path.exists():
+        results = load_cached_analysis(cache_path)
+        if results is not None:
+            return results
+
     with tempfile.TemporaryDirectory() as temp_dir:
         temp_dir_path = Path(temp_dir)
         
@@ -129,11 +267,16 @@ def run_analysis(
                     data["diameter_plot_bytes"] = None
         
         status_container.empty()
+        # An empty result usually means an input failed to load; don't persist it,
+        # so a transient read error isn't replayed after every restart
+        if results.get("vessels"):
+            store_cached_analysis(cache_path, results)
         return results
 
 # --- Plotting Helper Function ---
 def create_plot(traces, title):
     """Creates a Plotly figure with a standardized layout."""
+    traces = [trace for trace in traces if trace is not None]
     if not traces:
         st.warning(f"No data to display for: {title}.")
         return
@@ -196,9 +339,11 @@ with st.sidebar:
     st.header("Cache Options")
     if st.button("Clear Analysis Cache & Reset"):
         st.cache_data.clear()
+        # Everything in the directory is cache: entries, old formats and leftover temp files
+        for cache_file in ANALYSIS_CACHE_DIR.glob("*"):
+            cache_file.unlink(missing_ok=True)
         st.session_state.clear()
-        st.success("Cache cleared! App has been reset.")
-        time.sleep(2) 
+        st.toast("Cache cleared! App has been reset.", icon="✅")
         st.rerun()
 
 # --- Main App Logic ---
@@ -244,14 +389,14 @@ if st.session_state.results:
     if "point_cloud" in results:
         pcd_data = results["point_cloud"]
         if pcd_data and pcd_data.get("geometry"):
-            pcd_traces.append(pcd_to_plotly(pcd_data["geometry"], "Point Cloud", showlegend=True))
+            pcd_traces.append(pcd_to_plotly(pcd_data["geometry"], "Point Cloud", showlegend=True, max_points=MAX_PLOT_POINTS))
 
     for vessel_name, data in results.get("vessels", {}).items():
         color = colors.get(vessel_name, "gray")
         if data.get("mesh"):
             mesh_traces.append(mesh_to_plotly(data["mesh"], color=color, name=f"{vessel_name} Mesh", showlegend=True))
         if data.get("centerline"):
-            centerline_traces.append(lineset_to_plotly(data["centerline"], color="yellow", name=f"{vessel_name} Centerline", showlegend=True))
+            centerline_traces.extend(lineset_to_plotly(data["centerline"], color="yellow", name=f"{vessel_name} Centerline", showlegend=True))
         if data.get("max_diameter_disc"):
             centerline_traces.append(mesh_to_plotly(data["max_diameter_disc"], color="magenta", name=f"{vessel_name} Max Diameter", showlegend=True))
 
@@ -0,0 +1,26 @@
+import numpy as np
+from scipy.sparse.csgraph import minimum_spanning_tree
+from scipy.spatial import distance
+
+from utils.metrics_utils import centroid_distance_graph
+
+
+def _dense_mst_length(centroids):
+    return minimum_spanning_tree(distance.cdist(centroids, centroids)).sum()
+
+
+def test_centroid_distance_graph_matches_dense_mst_with_coincident_centroids():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        a, b = rng.random(3) * 100, rng.random(3) * 100
+        centroids = np.array([a, a, b])
+        mst_length = minimum_spanning_tree(centroid_distance_graph(centroids)).sum()
+        assert np.isclose(mst_length, _dense_mst_length(centroids))
+
+
+def test_centroid_distance_graph_matches_dense_mst():
+    rng = np.random.default_rng(1)
+    for _ in range(50):
+        centroids = rng.random((rng.integers(2, 60), 3)) * 100
+        mst_length = minimum_spanning_tree(centroid_distance_graph(centroids)).sum()
+        assert np.isclose(mst_length, _dense_mst_length(centroids))
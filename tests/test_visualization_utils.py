@@ -0,0 +1,118 @@
+import numpy as np
+
+from visualization_utils import (
+    MIN_SEGMENTS_PER_TRACE,
+    _marker_colors,
+    _voxel_decimate,
+    lineset_to_plotly,
+    mesh_to_plotly,
+)
+
+
+def _rgb_string(rgb):
+    return f"rgb({rgb[0]},{rgb[1]},{rgb[2]})"
+
+
+def _resolve_marker_colors(marker):
+    """Returns the color string Plotly would draw for each point of `marker`."""
+    if "colorscale" not in marker:
+        return list(marker["color"])
+    stops = np.array([stop for stop, _ in marker["colorscale"]])
+    scale_colors = [rgb for _, rgb in marker["colorscale"]]
+    resolved = []
+    for value in marker["color"]:
+        position = (float(value) - marker["cmin"]) / (marker["cmax"] - marker["cmin"])
+        matches = np.flatnonzero(np.isclose(stops, position))
+        assert len(matches) > 0, f"index {value} falls between colorscale stops"
+        resolved.append(scale_colors[matches[0]])
+    return resolved
+
+
+def _assert_marker_colors_roundtrip(colors):
+    resolved = _resolve_marker_colors(_marker_colors(colors))
+    assert resolved == [_rgb_string(rgb) for rgb in colors]
+
+
+def test_marker_colors_maps_points_back_to_their_rgb():
+    rng = np.random.default_rng(0)
+    palette = rng.integers(0, 256, size=(12, 3), dtype=np.uint8)
+    colors = palette[rng.integers(0, len(palette), size=500)]
+    marker = _marker_colors(colors)
+    assert "colorscale" in marker
+    _assert_marker_colors_roundtrip(colors)
+
+
+def test_marker_colors_single_color():
+    colors = np.tile(np.array([[10, 200, 30]], dtype=np.uint8), (20, 1))
+    marker = _marker_colors(colors)
+    assert marker["cmin"] < marker["cmax"]
+    _assert_marker_colors_roundtrip(colors)
+
+
+def test_marker_colors_full_palette():
+    # Exactly max_palette distinct colors still uses the colorscale
+    packed = np.arange(256, dtype=np.uint32) * 65_793
+    colors = np.stack([packed >> 16, (packed >> 8) & 0xFF, packed & 0xFF], axis=1).astype(np.uint8)
+    colors = np.random.default_rng(1).permutation(colors)
+    assert "colorscale" in _marker_colors(colors)
+    _assert_marker_colors_roundtrip(colors)
+
+
+def test_marker_colors_falls_back_to_strings_above_palette_limit():
+    colors = np.random.default_rng(2).integers(0, 256, size=(2000, 3), dtype=np.uint8)
+    assert len(np.unique(colors, axis=0)) > 256
+    marker = _marker_colors(colors)
+    assert "colorscale" not in marker
+    _assert_marker_colors_roundtrip(colors)
+
+
+def test_voxel_decimate_keeps_one_point_per_voxel():
+    rng = np.random.default_rng(3)
+    points = rng.normal(scale=20.0, size=(5000, 3))
+    voxel_size = 4.0
+    idx = _voxel_decimate(points, voxel_size)
+
+    cells = np.floor(points / voxel_size).astype(np.int64)
+    assert np.all(np.diff(idx) > 0)
+    assert len(np.unique(cells[idx], axis=0)) == len(idx)
+    assert len(idx) == len(np.unique(cells, axis=0))
+
+
+def test_lineset_traces_concatenate_to_unsplit_columns():
+    rng = np.random.default_rng(4)
+    points = rng.random((400, 3)) * 100
+    lines = rng.integers(0, len(points), size=(5 * MIN_SEGMENTS_PER_TRACE + 7, 2))
+    traces = lineset_to_plotly({"points": points, "lines": lines}, name="Centerline test")
+    assert len(traces) > 1
+    assert sum(trace.showlegend for trace in traces) == 1
+
+    segments = np.full((len(lines), 3, 3), np.nan, dtype=np.float32)
+    segments[:, :2] = points[lines]
+    expected = segments.reshape(-1, 3)
+    for axis, column in enumerate("xyz"):
+        joined = np.concatenate([np.asarray(trace[column]) for trace in traces])
+        np.testing.assert_array_equal(joined, expected[:, axis])
+
+
+def _triangle_geometry(trace):
+    vertices = np.stack([np.asarray(trace.x), np.asarray(trace.y), np.asarray(trace.z)], axis=1)
+    triangles = np.stack([np.asarray(trace.i), np.asarray(trace.j), np.asarray(trace.k)], axis=1)
+    corners = vertices[triangles].reshape(len(triangles), -1)
+    return corners[np.lexsort(corners.T[::-1])]
+
+
+def test_mesh_optimize_and_dedupe_keep_triangle_geometry():
+    rng = np.random.default_rng(5)
+    grid = rng.random((60, 3)).astype(np.float32) * 10
+    triangles = rng.integers(0, len(grid), size=(150, 3))
+    # Triangle soup: every corner gets its own vertex, plus some unused vertices
+    soup_vertices = np.concatenate([grid[triangles].reshape(-1, 3), rng.random((10, 3)).astype(np.float32)])
+    soup_triangles = np.arange(3 * len(triangles)).reshape(-1, 3)
+    mesh = {"vertices": soup_vertices, "triangles": soup_triangles}
+
+    reference = _triangle_geometry(mesh_to_plotly(mesh, name="reference"))
+    for optimize, dedupe in [(True, False), (False, True), (True, True)]:
+        trace = mesh_to_plotly(mesh, name="variant", optimize=optimize, dedupe=dedupe)
+        np.testing.assert_array_equal(_triangle_geometry(trace), reference)
+        if dedupe:
+            assert len(trace.x) <= len(np.unique(soup_vertices, axis=0))
@@ -1,18 +1,37 @@
-def compute_tangent(pts, i):
+import numpy as np
+
+
+def compute_tangents(pts):
     """
-    Compute the vector tangent to pts line in i-th point, using finite diffence method.
+    Compute the vectors tangent to pts line in every point, using finite difference method.
 
     Args:
-        pts: array [x, y, z] coordinates of centerline
-        i: int index of the coordinates
+        pts: array (N, 3) [x, y, z] coordinates of centerline
 
     Returns:
-        Tangent vector
+        array (N, 3) of tangent vectors, forward/backward differences at the ends
+        and central differences elsewhere
+    """
+    tangents = np.zeros_like(pts, dtype=np.float64)
+    if len(pts) < 2:
+        return tangents
+    tangents[0] = pts[1] - pts[0]
+    tangents[-1] = pts[-1] - pts[-2]
+    tangents[1:-1] = pts[2:] - pts[:-2]
+    return tangents
+
+
+def apply_affine(pts, affine):
     """
+    Apply a 4x4 affine matrix to an array of 3D points without building homogeneous coordinates.
 
-    if i == 0:
-        return pts[i + 1] - pts[i]
-    elif i == len(pts) - 1:
-        return pts[i] - pts[i - 1]
-    else:
-        return pts[i + 1] - pts[i - 1]
+    Args:
+        pts: array (N, 3) of point coordinates
+        affine: array (4, 4) affine matrix
+
+    Returns:
+        array (N, 3) of transformed coordinates
+    """
+    out = np.matmul(pts, affine[:3, :3].T)
+    out += affine[:3, 3]
+    return out
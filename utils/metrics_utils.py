@@ -1,11 +1,12 @@
-from utils.geometric_utils import compute_tangent
+from utils.geometric_utils import apply_affine, compute_tangents
 import numpy as np
 import open3d as o3d
 from scipy import ndimage
 from scipy.ndimage import distance_transform_edt, label, center_of_mass
-from scipy.sparse.csgraph import dijkstra, minimum_spanning_tree
-from scipy.spatial import distance
-from skimage.morphology import skeletonize, binary_opening
+from scipy.sparse.csgraph import connected_components, dijkstra, minimum_spanning_tree
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree, distance
+from skimage.morphology import skeletonize
 from utils.plot_utils import plot_diameter
 from pathlib import Path
 
@@ -16,8 +17,8 @@ def compute_centerline_metrics(mask, affine, name="Vessel", destination_folder=P
     - Also calculates tortuosity and a centerline quality metric.
 
     Args:
-        mask: np.array binary vessel segmentation mask
-        affine: array, affine matrix from nifti , including acquisition parameters
+        mask: np.array binary vessel segmentation mask, may be cropped around the vessel
+        affine: array, affine matrix mapping mask voxel indices to mm, including acquisition parameters
         name: str, vessel name
         debug_mode: bool
     """
@@ -29,10 +30,16 @@ def compute_centerline_metrics(mask, affine, name="Vessel", destination_folder=P
     is_isotropic = np.allclose(voxel_spacing[0], voxel_spacing[1]) and np.allclose(voxel_spacing[1], voxel_spacing[2])
     if is_isotropic: 
         structure = ndimage.generate_binary_structure(3, 3)
-        cleaned_mask = binary_opening(mask, footprint=structure)
     else:
         structure = ndimage.generate_binary_structure(3, 1)
-        cleaned_mask = binary_opening(mask, footprint=structure)
+    # Opening with the same border handling as skimage's binary_opening:
+    # erosion treats the outside as foreground, dilation as background
+    cleaned_mask = np.empty_like(mask, dtype=bool)
+    ndimage.binary_dilation(
+        ndimage.binary_erosion(mask, structure=structure, border_value=1),
+        structure=structure,
+        output=cleaned_mask,
+    )
 
     if not np.any(cleaned_mask):
         return None
@@ -48,8 +55,7 @@ def compute_centerline_metrics(mask, affine, name="Vessel", destination_folder=P
     skeleton_voxels = np.argwhere(skeleton)
     
     # Transform skeleton points from voxel space to mm space using the affine matrix
-    skeleton_voxels_hom = np.hstack([skeleton_voxels, np.ones((skeleton_voxels.shape[0], 1))])
-    skeleton_mm = (affine @ skeleton_voxels_hom.T).T[:, :3]
+    skeleton_mm = apply_affine(skeleton_voxels, affine)
 
 
     diameters_mm = distance_transform_edt(mask, sampling=voxel_spacing)[tuple(skeleton_voxels.T)] * 2
@@ -75,7 +81,7 @@ def compute_centerline_metrics(mask, affine, name="Vessel", destination_folder=P
     }
 
     # Use skeleton_mm for tangent calculation for accuracy in physical space
-    tangent = compute_tangent(skeleton_mm, max_diam_idx)
+    tangent = compute_tangents(skeleton_mm)[max_diam_idx]
     vis_data = {"vis_type": None, "points": None, "connections": None}
     metrics = {
         "diameters": diameter_stats,
@@ -94,11 +100,9 @@ def compute_centerline_metrics(mask, affine, name="Vessel", destination_folder=P
         
         if len(significant_fragment_labels) > 1:
             centroids_vox = np.array(center_of_mass(skeleton, labeled_skeleton, significant_fragment_labels))
-            centroids_hom = np.hstack([centroids_vox, np.ones((centroids_vox.shape[0], 1))])
-            centroids_mm = (affine @ centroids_hom.T).T[:, :3]
+            centroids_mm = apply_affine(centroids_vox, affine)
 
-            dist_matrix = distance.cdist(centroids_mm, centroids_mm)
-            mst = minimum_spanning_tree(dist_matrix)
+            mst = minimum_spanning_tree(centroid_distance_graph(centroids_mm))
             total_mst_length = mst.sum()
 
             distances, _ = dijkstra(csgraph=mst, directed=False, indices=0, return_predecessors=True)
@@ -118,29 +122,67 @@ def compute_centerline_metrics(mask, affine, name="Vessel", destination_folder=P
                 metrics["quality"] = max_path_length / total_mst_length
             metrics["length"] = max_path_length
 
-            path = []
+            # Walk the predecessors back from the far endpoint; the path visits
+            # each centroid at most once, so it fits in a preallocated array
+            path = np.empty(len(predecessors), dtype=np.int32)
+            path_len = 0
             current_node = second_endpoint_idx
             while current_node != -9999:
-                path.append(current_node)
+                path[path_len] = current_node
+                path_len += 1
                 current_node = predecessors[current_node]
-            path = path[::-1]
+            path = path[:path_len][::-1]
 
             vis_data["vis_type"] = "lines"
             vis_data["points"] = centroids_mm
-            vis_data["connections"] = np.array([path[:-1], path[1:]]).T
+            vis_data["connections"] = np.column_stack([path[:-1], path[1:]])
 
     return {"metrics": metrics, "vis_data": vis_data, "plot_path": plot_path}
 
 
+def centroid_distance_graph(centroids):
+    """
+    Build a sparse graph of the distances between centroids, keeping the pairs closer than
+    a radius that doubles until the graph is connected. Its minimum spanning tree is the same
+    as the one of the dense distance matrix, without storing all K x K distances. If the
+    graph is still disconnected once the radius covers every pair (coincident centroids
+    have no edge between them), the dense distance matrix is used instead.
+
+    Args:
+        centroids: array (K, 3) of centroid coordinates, K > 1
+
+    Returns:
+        scipy.sparse CSR matrix (K, K) of pairwise distances
+    """
+    tree = cKDTree(centroids)
+    extent = np.linalg.norm(np.ptp(centroids, axis=0))
+    max_distance = 2 * np.median(tree.query(centroids, k=2)[0][:, 1])
+    if max_distance <= 0:
+        max_distance = extent
+    while True:
+        graph = tree.sparse_distance_matrix(tree, max_distance, output_type="coo_matrix").tocsr()
+        # Coincident centroids stay unconnected, as they are in a dense distance matrix
+        graph.eliminate_zeros()
+        if connected_components(graph, directed=False)[0] == 1:
+            return graph
+        if max_distance >= extent:
+            break
+        max_distance *= 2
+    # At the extent radius, float rounding can still drop the farthest pair
+    return csr_matrix(distance.cdist(centroids, centroids))
+
+
 def compute_mesh_metrics(mesh):
     if not mesh.has_vertices() or not mesh.has_triangles():
         return 0, 0, False
-    mesh.remove_degenerate_triangles()
-    mesh.remove_duplicated_vertices()
-    mesh.remove_unreferenced_vertices()
-    surface_area = mesh.get_surface_area()
+    vertices = np.asarray(mesh.vertices)
+    triangles = np.asarray(mesh.triangles)
+    v0 = vertices[triangles[:, 0]]
+    cross = np.cross(vertices[triangles[:, 1]] - v0, vertices[triangles[:, 2]] - v0)
+    surface_area = 0.5 * float(np.linalg.norm(cross, axis=1).sum())
     is_watertight = mesh.is_watertight()
-    volume = mesh.get_volume() if is_watertight else 0
+    # Divergence theorem: sum of the signed tetrahedra spanned by each face and the origin
+    volume = abs(float(np.einsum("ij,ij->", v0, cross))) / 6.0 if is_watertight else 0
     return surface_area, volume, is_watertight
 
 
@@ -162,12 +204,11 @@ def compute_reconstruction_quality_metrics(points, mesh):
     scene.add_triangles(mesh_t)
     
     distances_orig_to_mesh = scene.compute_distance(
-        o3d.core.Tensor(points, dtype=o3d.core.Dtype.Float32)
+        o3d.core.Tensor(np.ascontiguousarray(points, dtype=np.float32), dtype=o3d.core.Dtype.Float32)
     ).numpy()
     
-    pcd_original = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
-    pcd_mesh = o3d.geometry.PointCloud(mesh.vertices)
-    distances_mesh_to_orig = np.asarray(pcd_mesh.compute_point_cloud_distance(pcd_original))
+    # Nearest original point for every mesh vertex
+    distances_mesh_to_orig, _ = cKDTree(points).query(np.asarray(mesh.vertices), workers=-1)
     
     mesh_goodness = np.mean(distances_orig_to_mesh)
     point_representation_goodness = np.mean(distances_mesh_to_orig)
@@ -1,8 +1,17 @@
-import matplotlib.pyplot as plt
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.figure import Figure
 from pathlib import Path
 import numpy as np
 import open3d as o3d
 import os
+from functools import lru_cache
+
+# A single figure is reused for every diameter plot: clearing its axes is much
+# cheaper than creating and closing a figure per vessel. It is not registered
+# with pyplot, so it is never displayed.
+_FIG = Figure(figsize=(10, 4))
+_AX = _FIG.add_subplot()
 
 def plot_diameter(diameters, output_dir, name, slice_ids=None):
     """
@@ -14,32 +23,39 @@ def plot_diameter(diameters, output_dir, name, slice_ids=None):
         name: str, name of the vessel
         slice_ids: np.array, id for each diameter measure
     """
-    plt.figure(figsize=(10, 4))
+    _AX.cla()
     if slice_ids is None:
-        plt.plot(np.arange(len(diameters)), diameters, "-o")
+        _AX.plot(np.arange(len(diameters)), diameters, "-o")
     else:
-        plt.plot(slice_ids, diameters, "-o")
+        _AX.plot(slice_ids, diameters, "-o")
 
     if slice_ids is None:
-        plt.xlabel("Centerline point index")
+        _AX.set_xlabel("Centerline point index")
     else:
-        plt.xlabel("Slice coordinate")
-    plt.ylabel("Diameter (mm)")
-    plt.title(f"{name} Diameter Along Centerline")
-    plt.grid(True)
-    plt.tight_layout()
+        _AX.set_xlabel("Slice coordinate")
+    _AX.set_ylabel("Diameter (mm)")
+    _AX.set_title(f"{name} Diameter Along Centerline")
+    _AX.grid(True)
+    _FIG.tight_layout()
 
     os.makedirs(output_dir, exist_ok=True)
     entire_file_path = Path(output_dir) / f"{'_'.join(name.split(' '))}.png"
-    plt.savefig(
-        entire_file_path, dpi=200
+    _FIG.savefig(
+        entire_file_path, dpi=150
     )
-    # The plot is closed to free up memory and prevent it from being displayed
-    # in non-interactive environments.
-    plt.close()
     return entire_file_path
 
 
+@lru_cache(maxsize=None)
+def _disc_triangles(resolution):
+    """
+    Triangle fan of a disc with a center vertex 0 and `resolution` rim vertices,
+    cached since it only depends on the resolution.
+    """
+    rim = np.arange(1, resolution + 1, dtype=np.int32)
+    return np.column_stack([np.zeros_like(rim), rim, np.roll(rim, -1)])
+
+
 def create_flat_disc(center, radius, normal, resolution=60):
     """
     Create a flat disc mesh centered at `center`, perpendicular to `normal`,
@@ -63,14 +79,13 @@ def create_flat_disc(center, radius, normal, resolution=60):
         
     # Step 1: Create disc in XY plane
     angles = np.linspace(0, 2 * np.pi, resolution, endpoint=False)
-    circle_points = np.c_[np.cos(angles), np.sin(angles), np.zeros_like(angles)] * radius
-    vertices = np.vstack([[0, 0, 0], circle_points])
-    triangles = [[0, i, i + 1] for i in range(1, resolution)]
-    triangles.append([0, resolution, 1])  
+    vertices = np.zeros((resolution + 1, 3))
+    vertices[1:, 0] = np.cos(angles) * radius
+    vertices[1:, 1] = np.sin(angles) * radius
 
     mesh = o3d.geometry.TriangleMesh()
     mesh.vertices = o3d.utility.Vector3dVector(vertices)
-    mesh.triangles = o3d.utility.Vector3iVector(triangles)
+    mesh.triangles = o3d.utility.Vector3iVector(_disc_triangles(resolution))
     mesh.compute_vertex_normals()
 
     # Step 2: Rotate to align normal with Z-axis
@@ -0,0 +1,52 @@
+import io
+import os
+from multiprocessing import context, forkserver, popen_forkserver, reduction, spawn, util
+
+
+class _NoMainForkServerPopen(popen_forkserver.Popen):
+    """
+    Forkserver Popen that doesn't ask the child to re-import the parent's __main__.
+
+    Under Streamlit, __main__ is the app script itself, so the default preparation
+    data makes every worker re-run the whole UI script as __mp_main__. Workers only
+    need importable modules, which they get from the preloaded forkserver and sys.path.
+    """
+
+    def _launch(self, process_obj):
+        prep_data = spawn.get_preparation_data(process_obj._name)
+        prep_data.pop("init_main_from_path", None)
+        prep_data.pop("init_main_from_name", None)
+        # The rest mirrors popen_forkserver.Popen._launch
+        buf = io.BytesIO()
+        context.set_spawning_popen(self)
+        try:
+            reduction.dump(prep_data, buf)
+            reduction.dump(process_obj, buf)
+        finally:
+            context.set_spawning_popen(None)
+
+        self.sentinel, w = forkserver.connect_to_new_process(self._fds)
+        # Keep a duplicate of the data pipe's write end as a sentinel of the
+        # parent process used by the child process.
+        _parent_w = os.dup(w)
+        self.finalizer = util.Finalize(self, util.close_fds, (_parent_w, self.sentinel))
+        with open(w, "wb", closefd=True) as f:
+            f.write(buf.getbuffer())
+        self.pid = forkserver.read_signed(self.sentinel)
+
+
+class _NoMainForkServerProcess(context.ForkServerProcess):
+    @staticmethod
+    def _Popen(process_obj):
+        return _NoMainForkServerPopen(process_obj)
+
+
+class NoMainForkServerContext(context.ForkServerContext):
+    """
+    Forkserver multiprocessing context whose processes skip the __main__ fix-up.
+
+    Pass it as `mp_context` to a ProcessPoolExecutor whose work functions live in
+    importable modules, and preload those modules with `set_forkserver_preload`.
+    """
+
+    Process = _NoMainForkServerProcess
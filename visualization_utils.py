@@ -1,73 +1,264 @@
 import plotly.graph_objects as go
+import plotly.io as pio
 import numpy as np
-from typing import Dict
+import functools
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
 
-def mesh_to_plotly(mesh_data: Dict[str, np.ndarray], color='gray', name='Mesh', showlegend=True):
-    """Converts mesh data (vertices, triangles) to a Plotly Mesh3d trace."""
+# orjson serializes NumPy arrays natively instead of walking them element by element
+pio.json.config.default_engine = "orjson"
+
+# Traces built for recently seen geometry, keyed by content so Streamlit reruns reuse them
+_TRACE_CACHE: "OrderedDict[tuple, object]" = OrderedDict()
+_TRACE_CACHE_SIZE = 32
+_TRACE_CACHE_LOCK = threading.Lock()
+
+# Above these sizes hover is disabled to save per-point hover state in the browser
+HOVER_MAX_POINTS = 50_000
+HOVER_MAX_TRIANGLES = 100_000
+
+# Segment buffer shared by every lineset_to_plotly call. It is module-level because
+# Streamlit starts a new script thread on each rerun; the lock serializes its users
+_LINE_SCRATCH = {"buf": None}
+_LINE_SCRATCH_LOCK = threading.Lock()
+# Large centerlines are split across several traces so WebGL can cull them separately
+MAX_LINE_TRACES = 16
+MIN_SEGMENTS_PER_TRACE = 1024
+
+def _fingerprint(data: Dict[str, np.ndarray]) -> bytes:
+    """Hashes the names, shapes, dtypes and contents of the arrays in `data`."""
+    digest = hashlib.blake2b(digest_size=16)
+    for key in sorted(data):
+        arr = np.ascontiguousarray(data[key])
+        digest.update(f"{key}:{arr.shape}:{arr.dtype.str}".encode())
+        digest.update(arr.data)
+    return digest.digest()
+
+def _memoize_trace(func):
+    """Caches the trace returned by `func` for identical geometry and arguments.
+
+    st.cache_data hands every rerun a fresh copy of the analysis results, so the
+    key is a content hash rather than the arrays' identity. Cached traces are
+    shared between callers; go.Figure copies them, so they must not be mutated.
+    """
+    @functools.wraps(func)
+    def wrapper(data, *args, **kwargs):
+        key = (func.__name__, _fingerprint(data), args, tuple(sorted(kwargs.items())))
+        with _TRACE_CACHE_LOCK:
+            if key in _TRACE_CACHE:
+                _TRACE_CACHE.move_to_end(key)
+                return _TRACE_CACHE[key]
+        trace = func(data, *args, **kwargs)
+        with _TRACE_CACHE_LOCK:
+            _TRACE_CACHE[key] = trace
+            if len(_TRACE_CACHE) > _TRACE_CACHE_SIZE:
+                _TRACE_CACHE.popitem(last=False)
+        return trace
+    return wrapper
+
+def _line_scratch(num_segments: int) -> np.ndarray:
+    """Returns a (num_segments, 3, 3) float32 view of the shared scratch buffer.
+
+    The buffer only grows, so repeated centerline conversions stop allocating
+    once warmed up. Callers must hold _LINE_SCRATCH_LOCK while using the view
+    and copy anything they keep out of it.
+    """
+    buf = _LINE_SCRATCH["buf"]
+    if buf is None or len(buf) < num_segments:
+        buf = np.empty((num_segments, 3, 3), dtype=np.float32)
+        _LINE_SCRATCH["buf"] = buf
+    return buf[:num_segments]
+
+def _to_soa_f32(v: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Splits an (N, 3) array into contiguous float32 x, y, z columns."""
+    return tuple(np.ascontiguousarray(v[:, axis], dtype=np.float32) for axis in range(3))
+
+def _marker_colors(colors: np.ndarray, max_palette: int = 256) -> Dict:
+    """Builds marker color settings for (N, 3) uint8 RGB colors.
+
+    Point clouds are colored from a small label palette, so each point is sent
+    as an index into a discrete colorscale instead of as its own color string.
+    Falls back to per-point 'rgb(r,g,b)' strings when there are too many
+    distinct colors for a colorscale.
+    """
+    # Pack each RGB triple into one uint32 so np.unique sorts scalars, not rows
+    packed = (colors[:, 0].astype(np.uint32) << 16) | (colors[:, 1].astype(np.uint32) << 8) | colors[:, 2]
+    palette_keys, color_idx = np.unique(packed, return_inverse=True)
+    palette = np.stack([palette_keys >> 16, (palette_keys >> 8) & 0xFF, palette_keys & 0xFF], axis=1)
+
+    # Format each distinct color once, then gather the strings per point
+    channels = [palette[:, c].astype(str) for c in range(3)]
+    palette_strings = np.char.add("rgb(", channels[0])
+    for channel in channels[1:]:
+        palette_strings = np.char.add(np.char.add(palette_strings, ","), channel)
+    palette_strings = np.char.add(palette_strings, ")")
+    if len(palette) > max_palette:
+        return dict(color=palette_strings[color_idx])
+
+    palette_strings = palette_strings.tolist()
+    if len(palette) == 1:
+        colorscale = [[0.0, palette_strings[0]], [1.0, palette_strings[0]]]
+    else:
+        stops = np.linspace(0.0, 1.0, len(palette))
+        colorscale = [[float(stop), rgb] for stop, rgb in zip(stops, palette_strings)]
+    return dict(
+        color=color_idx.reshape(-1).astype(np.uint8),
+        colorscale=colorscale,
+        cmin=0,
+        cmax=max(len(palette) - 1, 1),
+        showscale=False,
+    )
+
+def _optimize_vertex_fetch(vertices: np.ndarray, triangles: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Renumbers vertices in order of first use by the triangle list.
+
+    Consecutive triangles then read neighbouring vertices, and vertices not
+    referenced by any triangle are dropped.
+    """
+    used, first_use = np.unique(triangles.ravel(), return_index=True)
+    order = used[np.argsort(first_use)]
+    remap = np.empty(len(vertices), dtype=np.int32)
+    remap[order] = np.arange(len(order), dtype=np.int32)
+    return vertices[order], remap[triangles]
+
+@_memoize_trace
+def mesh_to_plotly(mesh_data: Dict[str, np.ndarray], color='gray', name='Mesh', showlegend=True,
+                   optimize: bool = False, dedupe: bool = False):
+    """Converts mesh data (vertices, triangles) to a Plotly Mesh3d trace.
+
+    If dedupe is set, vertices with identical coordinates are merged first, which
+    shrinks triangle-soup meshes. If optimize is set, vertices are then reordered
+    for vertex fetch locality.
+
+    Returns:
+        The Mesh3d trace, or None if the mesh has no triangles.
+    """
     vertices = mesh_data["vertices"]
     triangles = mesh_data["triangles"]
+    if vertices.size == 0 or triangles.size == 0:
+        return None
+    if dedupe:
+        vertices, inverse = np.unique(vertices, axis=0, return_inverse=True)
+        triangles = inverse.reshape(-1)[triangles]
+    if optimize:
+        vertices, triangles = _optimize_vertex_fetch(vertices, triangles)
+    x, y, z = _to_soa_f32(vertices)
+    i, j, k = np.ascontiguousarray(triangles.T, dtype=np.int32)
 
     trace = go.Mesh3d(
-        x=vertices[:, 0],
-        y=vertices[:, 1],
-        z=vertices[:, 2],
-        i=triangles[:, 0],
-        j=triangles[:, 1],
-        k=triangles[:, 2],
+        x=x,
+        y=y,
+        z=z,
+        i=i,
+        j=j,
+        k=k,
         color=color,
         opacity=0.7,
         name=name,
-        hoverinfo='name',
+        hoverinfo='skip' if len(i) > HOVER_MAX_TRIANGLES else 'name',
         showlegend=showlegend # FIX: Explicitly control legend visibility
     )
     return trace
 
-def pcd_to_plotly(pcd_data: Dict[str, np.ndarray], name='Point Cloud', showlegend=True):
-    """Converts point cloud data (points, colors) to a Plotly Scatter3d trace."""
+def _voxel_decimate(points: np.ndarray, voxel_size: float) -> np.ndarray:
+    """Returns the sorted indices of the first point in each occupied voxel."""
+    cells = np.floor(points / voxel_size).astype(np.int64)
+    cells -= cells.min(axis=0)
+    keys = np.ravel_multi_index(cells.T, cells.max(axis=0) + 1)
+    _, first_idx = np.unique(keys, return_index=True)
+    first_idx.sort()
+    return first_idx
+
+@_memoize_trace
+def pcd_to_plotly(pcd_data: Dict[str, np.ndarray], name='Point Cloud', showlegend=True,
+                  max_points: Optional[int] = None, voxel_size: Optional[float] = None):
+    """Converts point cloud data (points, colors) to a Plotly Scatter3d trace.
+
+    If voxel_size is given, the cloud is first reduced to one point per occupied
+    voxel of that edge length. If max_points is given and the cloud is still
+    larger, a reproducible uniform random subset of that many points is plotted.
+
+    Returns:
+        The Scatter3d trace, or None if the cloud has no points.
+    """
+    if len(pcd_data["points"]) == 0:
+        return None
     points = pcd_data["points"]
-    colors = pcd_data["colors"] * 255
+    colors = pcd_data["colors"]
+    if voxel_size is not None:
+        idx = _voxel_decimate(points, voxel_size)
+        points, colors = points[idx], colors[idx]
+    if max_points is not None and len(points) > max_points:
+        idx = np.random.default_rng(0).choice(len(points), max_points, replace=False)
+        idx.sort()
+        points, colors = points[idx], colors[idx]
+
+    x, y, z = _to_soa_f32(points)
+    # Multiply straight into uint8, without a float temporary the size of the cloud
+    quantized = np.empty(colors.shape, dtype=np.uint8)
+    np.multiply(colors, 255.0, out=quantized, casting='unsafe')
 
     trace = go.Scatter3d(
-        x=points[:, 0],
-        y=points[:, 1],
-        z=points[:, 2],
+        x=x,
+        y=y,
+        z=z,
         mode='markers',
         marker=dict(
             size=2,
-            color=colors,
-            opacity=0.8
+            opacity=0.8,
+            **_marker_colors(quantized)
         ),
         name=name,
-        hoverinfo='name',
+        hoverinfo='skip' if len(x) > HOVER_MAX_POINTS else 'name',
         showlegend=showlegend # FIX: Explicitly control legend visibility
     )
     return trace
 
+@_memoize_trace
 def lineset_to_plotly(lineset_data: Dict[str, np.ndarray], color='yellow', name='Centerline', showlegend=True):
-    """Converts lineset data (points, lines) to a Plotly Scatter3d trace with lines."""
-    points = lineset_data["points"]
+    """Converts lineset data (points, lines) to Plotly Scatter3d line traces.
+
+    Large linesets are split into up to MAX_LINE_TRACES traces of at least
+    MIN_SEGMENTS_PER_TRACE segments each, sharing one legend entry, so the
+    browser can draw and cull them independently.
+
+    Returns:
+        A list of Scatter3d traces, empty if the lineset has no segments.
+    """
+    # Matching the buffer dtype lets np.take write straight into it
+    points = np.asarray(lineset_data["points"], dtype=np.float32)
     lines = lineset_data["lines"]
+    if len(lines) == 0:
+        return []
     
-    x_lines, y_lines, z_lines = [], [], []
-
-    for line in lines:
-        p1 = points[line[0]]
-        p2 = points[line[1]]
-        x_lines.extend([p1[0], p2[0], None])
-        y_lines.extend([p1[1], p2[1], None])
-        z_lines.extend([p1[2], p2[2], None])
+    num_traces = int(np.clip(len(lines) // MIN_SEGMENTS_PER_TRACE, 1, MAX_LINE_TRACES))
+    with _LINE_SCRATCH_LOCK:
+        # Each segment becomes (p1, p2, NaN); Plotly breaks the line at the NaN
+        segments = _line_scratch(len(lines))
+        np.take(points, lines, axis=0, out=segments[:, :2])
+        segments[:, 2] = np.nan
+        # Copy the columns out before the buffer is released to other callers
+        chunk_columns = [
+            _to_soa_f32(chunk.reshape(-1, 3)) for chunk in np.array_split(segments, num_traces)
+        ]
 
-    trace = go.Scatter3d(
-        x=x_lines,
-        y=y_lines,
-        z=z_lines,
-        mode='lines',
-        line=dict(
-            color=color,
-            width=5
-        ),
-        name=name,
-        hoverinfo='name',
-        showlegend=showlegend # FIX: Explicitly control legend visibility
-    )
-    return trace
+    traces = []
+    for chunk_idx, (x_lines, y_lines, z_lines) in enumerate(chunk_columns):
+        traces.append(go.Scatter3d(
+            x=x_lines,
+            y=y_lines,
+            z=z_lines,
+            mode='lines',
+            connectgaps=False,  # the NaN separators must break the line between segments
+            line=dict(
+                color=color,
+                width=5
+            ),
+            name=name,
+            legendgroup=name,
+            hoverinfo='name',
+            showlegend=showlegend and chunk_idx == 0 # FIX: Explicitly control legend visibility
+        ))
+    return traces